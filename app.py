@@ -5,6 +5,10 @@ from pydantic import BaseModel, model_validator, conint, confloat
 # local
 from catalog import data_locations, data_formats, data_catalog
 from util import get_metadata, check_for_data_and_package_it, mockup_message
+from profiling import profiling_middleware, profiled
+from upstream import get_hedge_metrics
+from artifacts import Artifact, artifact_response
+from estimate import estimate_request
 
 
 #############################################################################################################
@@ -73,6 +77,9 @@ app = FastAPI(
     },
 )
 
+# Opt-in per-request profiling and slow request capture (see profiling.py)
+app.middleware("http")(profiling_middleware)
+
 ############################################################################################################
 # MODELS
 ############################################################################################################
@@ -121,6 +128,8 @@ class GeneralDataParameters(BaseModel, extra="forbid"):
     format: Literal[(tuple(formats["all"]))] = formats["default"]
     lat: confloat(ge=-90, le=90) | None = None
     lon: confloat(ge=-180, le=180) | None = None
+    # if true, return an estimate of the size and cost of the request instead of the data
+    dry_run: bool = False
 
     # General validation functions (for fields that are in the parent model)
     @model_validator(mode="after")
@@ -241,36 +250,69 @@ def root(parameters: Annotated[AboutParameters, Query()]):
     return mockup_message(parameters, "about")
 
 
+@app.get("/metrics/upstream/", include_in_schema=False)
+def upstream_metrics():
+    """
+    Returns hedged request metrics for the Rasdaman backends (hedge rate, wins, current hedge delay and budget).
+    """
+    return get_hedge_metrics()
+
+
 @app.get("/data/atmosphere/", tags=["data"])
+@profiled
 def root(parameters: Annotated[AtmosphereDataParameters, Query()]):
+    if parameters.dry_run:
+        return estimate_request("atmosphere", parameters)
     packaged_data = check_for_data_and_package_it("atmosphere", parameters)
+    if isinstance(packaged_data, Artifact):
+        return artifact_response(packaged_data)
     # return packaged_data # not implemented yet
     return mockup_message(parameters, "atmosphere")
 
 
 @app.get("/data/hydrosphere/", tags=["data"])
+@profiled
 def root(parameters: Annotated[HydrosphereDataParameters, Query()]):
+    if parameters.dry_run:
+        return estimate_request("hydrosphere", parameters)
     packaged_data = check_for_data_and_package_it("hydrosphere", parameters)
+    if isinstance(packaged_data, Artifact):
+        return artifact_response(packaged_data)
     # return packaged_data # not implemented yet
     return mockup_message(parameters, "hydrosphere")
 
 
 @app.get("/data/biosphere/", tags=["data"])
+@profiled
 def root(parameters: Annotated[BiosphereDataParameters, Query()]):
+    if parameters.dry_run:
+        return estimate_request("biosphere", parameters)
     packaged_data = check_for_data_and_package_it("biosphere", parameters)
+    if isinstance(packaged_data, Artifact):
+        return artifact_response(packaged_data)
     # return packaged_data # not implemented yet
     return mockup_message(parameters, "biosphere")
 
 
 @app.get("/data/cryosphere/", tags=["data"])
+@profiled
 def root(parameters: Annotated[CryosphereDataParameters, Query()]):
+    if parameters.dry_run:
+        return estimate_request("cryosphere", parameters)
     packaged_data = check_for_data_and_package_it("cryosphere", parameters)
+    if isinstance(packaged_data, Artifact):
+        return artifact_response(packaged_data)
     # return packaged_data # not implemented yet
     return mockup_message(parameters, "cryosphere")
 
 
 @app.get("/data/anthroposphere/", tags=["data"])
+@profiled
 def root(parameters: Annotated[AnthroposphereDataParameters, Query()]):
+    if parameters.dry_run:
+        return estimate_request("anthroposphere", parameters)
     packaged_data = check_for_data_and_package_it("anthroposphere", parameters)
+    if isinstance(packaged_data, Artifact):
+        return artifact_response(packaged_data)
     # return packaged_data # not implemented yet
     return mockup_message(parameters, "anthroposphere")
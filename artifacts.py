@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import Counter
+from typing import NamedTuple
+
+from fastapi.responses import FileResponse, Response
+
+from catalog import catalog_version
+
+
+#############################################################################################################
+# SETTINGS
+#############################################################################################################
+
+# Packaged binary outputs are stored on local disk, so repeat downloads and resumed downloads
+# are served straight from the file without fetching or packaging the data again.
+artifact_dir = os.environ.get("API_ARTIFACT_DIR", "artifacts")
+# once the stored outputs exceed this size, the least recently used outputs are deleted
+artifact_max_bytes = int(os.environ.get("API_ARTIFACT_MAX_BYTES", 10 * 1024**3))
+# outputs used within this many seconds are never evicted, so a file is not deleted just before it is opened
+# (e.g. by nginx after an X-Accel-Redirect, or by another worker process); once a file is open, deleting it is harmless
+artifact_evict_grace = float(os.environ.get("API_ARTIFACT_EVICT_GRACE_SECONDS", 60))
+# If the app runs behind nginx, set this to the internal location that maps to the artifact directory.
+# nginx will then send the file itself (using sendfile, with Range support) instead of the app streaming it.
+artifact_accel_redirect = os.environ.get("API_ARTIFACT_ACCEL_REDIRECT")
+
+# only these formats are stored as artifacts, with these media types and file extensions
+artifact_formats = {
+    "netcdf": {"media_type": "application/x-netcdf", "extension": "nc"},
+    "geotiff": {"media_type": "image/tiff", "extension": "tif"},
+}
+
+
+#############################################################################################################
+# STORE
+#############################################################################################################
+
+# The store is content-addressed, with two directories:
+# - "objects" holds the outputs themselves, named by the sha256 of their contents, so identical outputs are stored once
+# - "keys" maps a request key (a hash of the catalog version and normalized request parameters) to an object
+# Least recently used objects are evicted first, using the file access time as the time of last use.
+# Objects returned by get_artifact() and put_artifact() are pinned until their response has been sent,
+# so eviction by another request can never delete a file that is about to be served.
+# Pins only cover this process and responses sent by the app, so recently used objects are also kept for a grace period
+# (see artifact_evict_grace), which covers files sent by nginx after the response, and other worker processes.
+
+
+class Artifact(NamedTuple):
+    path: str
+    digest: str
+    media_type: str
+    filename: str
+
+
+_lock = threading.Lock()
+# number of responses currently sending each object, by digest
+_pinned = Counter()
+
+
+def artifact_key(service_category, parameters):
+    """
+    Returns the request key for a validated request: a hash of the catalog version and the normalized parameters.
+    Parameters are normalized by sorting list values, so equivalent requests get the same key.
+    """
+    normalized = {
+        field: sorted(value) if isinstance(value, list) else value
+        for field, value in parameters.model_dump(exclude={"dry_run"}).items()
+    }
+    request = {
+        "catalog_version": catalog_version,
+        "service_category": service_category,
+        "parameters": normalized,
+    }
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+
+def _object_path(digest):
+    return os.path.join(artifact_dir, "objects", digest)
+
+
+def _key_path(key):
+    return os.path.join(artifact_dir, "keys", f"{key}.json")
+
+
+def _write_atomic(path, data):
+    # write to a temporary file in the same directory and rename it, so readers never see a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _touch(path):
+    # only update the access time: the modification time is left alone, since clients resume downloads against it
+    stat_result = os.stat(path)
+    os.utime(path, (time.time(), stat_result.st_mtime))
+
+
+def get_artifact(key):
+    """
+    Returns the stored Artifact for a request key, or None if there is none (or it has been evicted).
+    The returned Artifact is pinned, and must be released with release_artifact() (artifact_response() does this).
+    """
+    try:
+        with open(_key_path(key)) as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    path = _object_path(entry["digest"])
+    with _lock:
+        try:
+            _touch(path)
+        except FileNotFoundError:
+            # the object was evicted, so the key is stale
+            try:
+                os.remove(_key_path(key))
+            except FileNotFoundError:
+                pass
+            return None
+        _pinned[entry["digest"]] += 1
+    return Artifact(path, entry["digest"], entry["media_type"], entry["filename"])
+
+
+def put_artifact(key, data, format, filename):
+    """
+    Stores packaged output bytes under a request key, and returns the Artifact.
+    If identical bytes are already stored (for any request), the existing object is reused.
+    The returned Artifact is pinned, like the ones returned by get_artifact().
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    path = _object_path(digest)
+    media_type = artifact_formats[format]["media_type"]
+    filename = f"{filename}.{artifact_formats[format]['extension']}"
+
+    # the object is written without holding the lock, so cache hits are not blocked by a large write;
+    # the temporary file and rename already keep readers from seeing a partial file
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+
+    with _lock:
+        try:
+            _touch(path)
+        except FileNotFoundError:
+            # evicted between writing it and taking the lock (only possible without a grace period)
+            _write_atomic(path, data)
+        entry = {"digest": digest, "media_type": media_type, "filename": filename}
+        _write_atomic(_key_path(key), json.dumps(entry).encode())
+        _pinned[digest] += 1
+        evict_artifacts()
+
+    return Artifact(path, digest, media_type, filename)
+
+
+def release_artifact(artifact):
+    """
+    Unpins an Artifact once its response has been sent, so it can be evicted again.
+    """
+    with _lock:
+        _pinned[artifact.digest] -= 1
+        if _pinned[artifact.digest] <= 0:
+            del _pinned[artifact.digest]
+
+
+def evict_artifacts():
+    """
+    Deletes the least recently used objects until the store is within its size limit.
+    Pinned objects (about to be served) and objects used within the grace period are never deleted.
+    Must be called with the lock held.
+    Keys pointing to deleted objects are cleaned up the next time they are looked up.
+    """
+    objects_dir = os.path.join(artifact_dir, "objects")
+    objects = []
+    for entry in os.scandir(objects_dir):
+        if entry.is_file() and not entry.name.startswith(".tmp"):
+            stat_result = entry.stat()
+            objects.append((stat_result.st_atime, stat_result.st_size, entry))
+
+    total = sum(size for _, size, _ in objects)
+    recently_used = time.time() - artifact_evict_grace
+    for last_used, size, entry in sorted(objects, key=lambda item: item[0]):
+        if total <= artifact_max_bytes or last_used > recently_used:
+            break
+        if entry.name in _pinned:
+            continue
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+class _ReleaseArtifactMixin:
+    # releases the artifact once the response is done, however it ends: sent, rejected (e.g. a 416 for a bad Range),
+    # or interrupted by the client disconnecting
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            release_artifact(self.artifact)
+
+
+class ArtifactFileResponse(_ReleaseArtifactMixin, FileResponse):
+    pass
+
+
+class ArtifactRedirectResponse(_ReleaseArtifactMixin, Response):
+    pass
+
+
+def artifact_response(artifact):
+    """
+    Returns a response that sends the artifact file, with support for HTTP Range requests (partial content).
+    The ETag is the content hash, so it stays valid for resumed downloads as long as the content is the same.
+    The artifact is released once the response is done.
+    """
+    headers = {"ETag": f'"{artifact.digest}"'}
+    if artifact_accel_redirect:
+        headers["X-Accel-Redirect"] = (
+            f"{artifact_accel_redirect.rstrip('/')}/objects/{artifact.digest}"
+        )
+        headers["Content-Disposition"] = f'attachment; filename="{artifact.filename}"'
+        response = ArtifactRedirectResponse(
+            media_type=artifact.media_type, headers=headers
+        )
+    else:
+        response = ArtifactFileResponse(
+            artifact.path,
+            media_type=artifact.media_type,
+            filename=artifact.filename,
+            headers=headers,
+        )
+    response.artifact = artifact
+    return response
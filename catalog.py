@@ -1,3 +1,7 @@
+import hashlib
+import json
+import os
+
 # these would be pulled from GeoServer, and would have to include polygons somehow
 data_locations = {
     "all": ["AK1", "AK2", "AK3", "AK4", "AK5", "AK6", "AK7", "AK8", "AK9", "AK10"],
@@ -340,3 +344,18 @@ data_catalog = {
         },
     },
 }
+
+# a short hash of the catalog contents, which changes whenever the catalog changes
+# this is used to make sure cached outputs are not reused after the underlying data has changed
+catalog_version = hashlib.sha256(
+    json.dumps(data_catalog, sort_keys=True).encode()
+).hexdigest()[:16]
+
+# coverage metadata fetched from Rasdaman (see metadata_catalog_demo/rasdaman_metadata_rodeo.ipynb)
+# this includes axis bounds, encodings and bands for each coverage, and is used to estimate request sizes
+with open(
+    os.path.join(
+        os.path.dirname(__file__), "metadata_catalog_demo", "coverage_metadata.json"
+    )
+) as f:
+    coverage_metadata = json.load(f)
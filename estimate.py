@@ -0,0 +1,185 @@
+import os
+
+from fastapi import HTTPException
+
+from catalog import data_catalog, coverage_metadata
+
+
+#############################################################################################################
+# SETTINGS
+#############################################################################################################
+
+# Synchronous requests estimated to exceed any of these limits are rejected before any data is fetched.
+# Limits are opt-in: a limit that is not set in the environment is not enforced.
+max_cells = int(os.environ["API_MAX_CELLS"]) if "API_MAX_CELLS" in os.environ else None
+max_bytes = int(os.environ["API_MAX_BYTES"]) if "API_MAX_BYTES" in os.environ else None
+max_upstream_queries = (
+    int(os.environ["API_MAX_UPSTREAM_QUERIES"])
+    if "API_MAX_UPSTREAM_QUERIES" in os.environ
+    else None
+)
+
+# Locations are polygons, but their geometries are not in the catalog yet (TBD, from GeoServer),
+# so we assume every location covers this many grid cells.
+location_cells = int(os.environ.get("API_LOCATION_CELLS", 10_000))
+
+# rough size of one value in each output format: 4 bytes for float32 in binary formats, text for json and csv
+bytes_per_value = {"json": 12, "csv": 10, "netcdf": 4, "geotiff": 4}
+
+# Coverage axes are sorted into three groups, and every other axis (model, scenario, era, decade, ...) multiplies the output.
+# The time steps along the time axes come from the requested year range and the source frequency,
+# and the variable axis is selected by the requested variable.
+spatial_axes = ["X", "Y", "lat", "lon"]
+year_axes = ["year", "ansi", "time"]
+time_axes = year_axes + ["month"]
+variable_axes = ["varname", "variable", "indicator"]
+
+
+#############################################################################################################
+# ESTIMATION
+#############################################################################################################
+
+
+def get_axis_cardinality(coverage, axis):
+    """
+    Returns the number of values along a coverage axis, using the encodings if the axis has them.
+    Otherwise the axis bounds are only used if the axis is a dense index (integer bounds starting at 0),
+    since other integer axes may be irregular (e.g. return intervals 2, 5, 10, ... 1000).
+    Axes that can't be counted are assumed to have a single value.
+    """
+    encodings = coverage["encodings"] or {}
+    if axis in encodings:
+        return len(encodings[axis])
+    bounds = coverage["axis_info"][axis]
+    if bounds["lowerBound"] != "0":
+        return 1
+    try:
+        return int(bounds["upperBound"]) + 1
+    except ValueError:
+        return 1
+
+
+def get_time_steps(parameters, source, coverage):
+    """
+    Returns the number of time steps requested from a source, clipped to the years of the source
+    (and to the time axis of the coverage, if there is metadata for it).
+    Coverages without a year axis (e.g. summarized by era or decade) have a single time step per month axis value,
+    since their era or decade axis is counted with the other axes.
+    """
+    start_year = getattr(parameters, "start_year", source["start_year"])
+    end_year = getattr(parameters, "end_year", source["end_year"])
+    start_year = max(start_year, source["start_year"])
+    end_year = min(end_year, source["end_year"])
+
+    if coverage is not None:
+        for axis in year_axes:
+            if axis in coverage["axis_info"]:
+                bounds = coverage["axis_info"][axis]
+                # some year axes are indexes (0, 1, ...) rather than years, and can't be used to clip the range
+                if len(bounds["lowerBound"]) < 4:
+                    continue
+                try:
+                    start_year = max(start_year, int(bounds["lowerBound"][:4]))
+                    end_year = min(end_year, int(bounds["upperBound"][:4]))
+                except ValueError:
+                    pass
+
+    years = max(0, end_year - start_year + 1)
+    if years == 0:
+        return 0
+    if coverage is not None and not any(
+        axis in coverage["axis_info"] for axis in year_axes
+    ):
+        return 12 if "month" in coverage["axis_info"] else 1
+    if source["frequency"] == "monthly":
+        return years * 12
+    return years
+
+
+def estimate_request(service_category, parameters, catalog=data_catalog):
+    """
+    Estimates the size and cost of a validated request before any data is fetched:
+    the number of cells (values), the number of bytes in the requested format, and the number of upstream queries.
+    Uses the variable sources in the catalog, and the axis bounds, encodings and bands in the coverage metadata.
+    Coverages that are not in the coverage metadata are counted without any extra axes.
+    """
+    if parameters.location is not None:
+        spatial_units = len(parameters.location)
+        cells_per_unit = location_cells
+    else:
+        spatial_units = 1
+        cells_per_unit = 1
+
+    sources = []
+    # a variable requested more than once is only fetched once
+    for variable in dict.fromkeys(parameters.variable):
+        variable_sources = catalog["service_category"][service_category]["variable"][
+            variable
+        ]["source"]
+        for source_id, source in variable_sources.items():
+            coverage = coverage_metadata.get(source["coverage_id"])
+            time_steps = get_time_steps(parameters, source, coverage)
+            if time_steps == 0:
+                continue
+
+            axis_combinations = 1
+            bands = 1
+            if coverage is not None:
+                for axis in coverage["axis_info"]:
+                    if axis not in spatial_axes + time_axes + variable_axes:
+                        axis_combinations *= get_axis_cardinality(coverage, axis)
+                if coverage["bands"] and variable not in coverage["bands"]:
+                    bands = len(coverage["bands"])
+
+            sources.append(
+                {
+                    "variable": variable,
+                    "source": source_id,
+                    "coverage_id": source["coverage_id"],
+                    "time_steps": time_steps,
+                    "axis_combinations": axis_combinations,
+                    "bands": bands,
+                    "cells": time_steps
+                    * axis_combinations
+                    * bands
+                    * cells_per_unit
+                    * spatial_units,
+                    "upstream_queries": spatial_units,
+                }
+            )
+
+    cells = sum(source["cells"] for source in sources)
+    upstream_queries = sum(source["upstream_queries"] for source in sources)
+    return {
+        "service_category": service_category,
+        "format": parameters.format,
+        "cells": cells,
+        "bytes": cells * bytes_per_value[parameters.format],
+        "upstream_queries": upstream_queries,
+        "sources": sources,
+        "limits": {
+            "cells": max_cells,
+            "bytes": max_bytes,
+            "upstream_queries": max_upstream_queries,
+        },
+    }
+
+
+def check_request_limits(estimate):
+    """
+    Rejects a request with a 413 error if its estimate exceeds any of the limits that are set.
+    The error includes the estimate, so the user can see how to narrow the request.
+    """
+    exceeded = [
+        limit
+        for limit, maximum in estimate["limits"].items()
+        if maximum is not None and estimate[limit] > maximum
+    ]
+    if exceeded:
+        raise HTTPException(
+            status_code=413,
+            detail={
+                "message": f"Request is too large ({', '.join(exceeded)} over the limit). Please request fewer variables, a shorter time range, or fewer locations.",
+                "estimate": estimate,
+            },
+        )
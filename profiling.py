@@ -0,0 +1,293 @@
+import cProfile
+import contextvars
+import functools
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+
+#############################################################################################################
+# SETTINGS
+#############################################################################################################
+
+# Opt-in profiling: a request is profiled only if it carries this header AND its value matches the admin token.
+# If no admin token is set in the environment, profiling is switched off entirely.
+profile_header = "X-Profile-Token"
+profile_token = os.environ.get("API_PROFILE_TOKEN")
+# number of rows to print for the cumulative listing and the call tree
+profile_limit = int(os.environ.get("API_PROFILE_LIMIT", 40))
+
+# Slow request capture: the stacks of every request are sampled from the start, and if the request ends up
+# running longer than the threshold, the samples are written to a local directory that keeps only the most recent files.
+# Slow request capture is opt-in: it is switched off unless a threshold is set in the environment.
+slow_request_threshold = (
+    float(os.environ["API_SLOW_REQUEST_SECONDS"])
+    if "API_SLOW_REQUEST_SECONDS" in os.environ
+    else None
+)
+slow_request_dir = os.environ.get("API_SLOW_REQUEST_DIR", "slow_requests")
+slow_request_max_files = int(os.environ.get("API_SLOW_REQUEST_MAX_FILES", 100))
+slow_request_sample_interval = float(
+    os.environ.get("API_SLOW_REQUEST_SAMPLE_INTERVAL", 0.01)
+)
+
+
+#############################################################################################################
+# REQUEST STATE
+#############################################################################################################
+
+# Each request gets a RequestProfile that is visible to the middleware (event loop thread)
+# and to the route function (threadpool worker thread), since contextvars are copied into the worker.
+# This lets us profile/sample both halves of the request:
+# pydantic validation and response serialization run in the event loop thread,
+# while the route body (catalog subsetting, fetching, packaging) runs in a worker thread.
+
+
+class RequestProfile:
+    def __init__(self, request, profiled):
+        self.path = request.url.path
+        self.parameters = normalize_query_params(request.query_params)
+        self.start = time.perf_counter()
+        self.thread_ids = set()
+        self.profilers = []
+        self.profiled = profiled
+        self.samples = Counter()
+        self.sample_count = 0
+
+
+_request_profile = contextvars.ContextVar("request_profile", default=None)
+
+# cProfile can only profile one request per thread at a time, so opt-in profiling is serialized
+_profiling_lock = threading.Lock()
+
+# requests currently in flight, watched by the slow request sampler thread
+_inflight = {}
+_inflight_lock = threading.Lock()
+_sampler_started = False
+
+
+def normalize_query_params(query_params):
+    """
+    Returns the query parameters as a dict with sorted keys and sorted values, so equivalent requests look the same.
+    """
+    return {
+        key: sorted(query_params.getlist(key)) for key in sorted(query_params.keys())
+    }
+
+
+def profiling_requested(request):
+    """
+    Checks if the request carries a valid admin token in the profiling header.
+    """
+    if not profile_token:
+        return False
+    token = request.headers.get(profile_header)
+    if token is None:
+        return False
+    return hmac.compare_digest(token.encode(), profile_token.encode())
+
+
+#############################################################################################################
+# MIDDLEWARE
+#############################################################################################################
+
+
+async def profiling_middleware(request, call_next):
+    """
+    Wraps every request to support opt-in profiling and slow request capture.
+    If profiling is requested, the response body is replaced with a call-tree profile of the request.
+    """
+    profiling = profiling_requested(request) and _profiling_lock.acquire(blocking=False)
+    profile = RequestProfile(request, profiling)
+    profile.thread_ids.add(threading.get_ident())
+    context_token = _request_profile.set(profile)
+    if slow_request_threshold is not None:
+        _watch(profile)
+
+    if profiling:
+        profiler = cProfile.Profile()
+        profile.profilers.append(profiler)
+        profiler.enable()
+    try:
+        response = await call_next(request)
+        if profiling:
+            # consume the original body before the profiler is disabled,
+            # so the call tree also covers streaming the response
+            async for _ in response.body_iterator:
+                pass
+    finally:
+        if profiling:
+            profiler.disable()
+            _profiling_lock.release()
+        _unwatch(profile)
+        _request_profile.reset(context_token)
+
+    duration = time.perf_counter() - profile.start
+    if slow_request_threshold is not None and duration > slow_request_threshold:
+        # file writes are blocking, so they run in a worker thread instead of on the event loop
+        await run_in_threadpool(
+            write_slow_request, profile, duration, response.status_code
+        )
+
+    if profiling:
+        return PlainTextResponse(
+            format_profile(profile, duration),
+            headers={"X-Profile-Status-Code": str(response.status_code)},
+        )
+    return response
+
+
+def profiled(func):
+    """
+    Decorator for route functions. Registers the worker thread running the route with the current request,
+    and profiles the route body if profiling was requested.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profile = _request_profile.get()
+        if profile is None:
+            return func(*args, **kwargs)
+
+        thread_id = threading.get_ident()
+        profile.thread_ids.add(thread_id)
+        try:
+            if not profile.profiled:
+                return func(*args, **kwargs)
+            profiler = cProfile.Profile()
+            profile.profilers.append(profiler)
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            profile.thread_ids.discard(thread_id)
+
+    return wrapper
+
+
+def format_profile(profile, duration):
+    """
+    Combines the profiles from all threads that served the request and returns them as text:
+    a cumulative listing followed by the call tree (callees of each function).
+    """
+    stream = io.StringIO()
+    stream.write(f"Profile of {profile.path} {profile.parameters}\n")
+    stream.write(f"Total request time: {duration:.4f} s\n")
+    stats = pstats.Stats(*profile.profilers, stream=stream)
+    stats.strip_dirs().sort_stats("cumulative")
+    stats.print_stats(profile_limit)
+    stats.print_callees(profile_limit)
+    return stream.getvalue()
+
+
+#############################################################################################################
+# SLOW REQUEST CAPTURE
+#############################################################################################################
+
+
+def _watch(profile):
+    global _sampler_started
+    with _inflight_lock:
+        _inflight[id(profile)] = profile
+        if not _sampler_started:
+            threading.Thread(
+                target=_sample_slow_requests, name="slow-request-sampler", daemon=True
+            ).start()
+            _sampler_started = True
+
+
+def _unwatch(profile):
+    with _inflight_lock:
+        _inflight.pop(id(profile), None)
+
+
+def _sample_slow_requests():
+    """
+    Runs forever in a background thread. Every sample interval, records the current stack
+    of each thread serving an in-flight request. Requests are sampled from the start, so a slow request
+    also has samples of whatever was slow early on; the samples are only kept if the request ends up slow.
+    Stacks are stored in "folded" form (outermost;...;innermost) so they can be fed to flamegraph tools.
+    Note that the event loop thread is shared by all requests, so its samples may include other requests' work.
+    """
+    while True:
+        time.sleep(slow_request_sample_interval)
+        with _inflight_lock:
+            inflight = list(_inflight.values())
+        if not inflight:
+            continue
+        frames = sys._current_frames()
+        # fold each thread's stack once per sample, since threads like the event loop serve many requests at once
+        stacks = {}
+        for profile in inflight:
+            for thread_id in list(profile.thread_ids):
+                if thread_id not in stacks:
+                    frame = frames.get(thread_id)
+                    stacks[thread_id] = _fold_stack(frame) if frame else None
+                if stacks[thread_id] is not None:
+                    profile.samples[stacks[thread_id]] += 1
+            profile.sample_count += 1
+
+
+def _fold_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+        )
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def write_slow_request(profile, duration, status_code):
+    """
+    Writes the stack samples of a slow request to a JSON file in the slow request directory,
+    then deletes the oldest files so the directory never holds more than the maximum number of files.
+    Errors writing the file (e.g. a full or read-only disk) are logged, and never fail the request.
+    """
+    try:
+        _write_slow_request(profile, duration, status_code)
+    except OSError as error:
+        logger.warning(f"Could not write slow request capture: {error}")
+
+
+def _write_slow_request(profile, duration, status_code):
+    os.makedirs(slow_request_dir, exist_ok=True)
+    timestamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    filename = os.path.join(
+        slow_request_dir, f"{timestamp}_{uuid.uuid4().hex[:8]}.json"
+    )
+    record = {
+        "path": profile.path,
+        "parameters": profile.parameters,
+        "status_code": status_code,
+        "duration": round(duration, 4),
+        "threshold": slow_request_threshold,
+        "sample_interval": slow_request_sample_interval,
+        "sample_count": profile.sample_count,
+        "stacks": dict(profile.samples.most_common()),
+    }
+    with open(filename, "w") as f:
+        json.dump(record, f, indent=4)
+
+    # filenames start with a timestamp, so sorting by name puts the oldest first
+    files = sorted(
+        name for name in os.listdir(slow_request_dir) if name.endswith(".json")
+    )
+    for old_file in files[:-slow_request_max_files]:
+        try:
+            os.remove(os.path.join(slow_request_dir, old_file))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,51 @@
+import argparse
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A stand-in for a Rasdaman WCS endpoint, used to try out hedged requests (see upstream.py) locally.
+# Start two stubs with different injected latencies, and point the app at both of them, e.g.:
+#   python rasdaman_stub.py --port 8001 --latency 0.05
+#   python rasdaman_stub.py --port 8002 --latency 0.05 --slow-latency 2 --slow-fraction 0.1
+#   RASDAMAN_URLS=http://localhost:8001/ows,http://localhost:8002/ows fastapi dev app.py
+
+
+def make_handler(name, latency, slow_latency, slow_fraction):
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # inject latency: most requests take `latency` seconds, a fraction of them take `slow_latency` seconds
+            if random.random() < slow_fraction:
+                time.sleep(slow_latency)
+            else:
+                time.sleep(latency)
+            body = f"{name} {self.path}".encode()
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # the client cancelled this request because another replica answered first
+                pass
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Stub Rasdaman server with injected latency"
+    )
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--slow-latency", type=float, default=0.0)
+    parser.add_argument("--slow-fraction", type=float, default=0.0)
+    args = parser.parse_args()
+
+    handler = make_handler(
+        f"stub:{args.port}", args.latency, args.slow_latency, args.slow_fraction
+    )
+    ThreadingHTTPServer(("localhost", args.port), handler).serve_forever()
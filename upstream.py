@@ -0,0 +1,246 @@
+import asyncio
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+import httpx
+
+
+#############################################################################################################
+# SETTINGS
+#############################################################################################################
+
+# Equivalent Rasdaman backends (replicas serving the same coverages), as a comma separated list of WCS endpoints.
+rasdaman_urls = os.environ.get(
+    "RASDAMAN_URLS", "https://zeus.snap.uaf.edu/rasdaman/ows"
+).split(",")
+
+# A query that has not answered after the hedge delay is sent to a second replica.
+# The hedge delay is the given percentile of recent upstream latencies,
+# or the initial delay until enough latencies have been recorded.
+hedge_percentile = float(os.environ.get("RASDAMAN_HEDGE_PERCENTILE", 95))
+hedge_initial_delay = float(os.environ.get("RASDAMAN_HEDGE_INITIAL_DELAY", 1.0))
+hedge_min_delay = float(os.environ.get("RASDAMAN_HEDGE_MIN_DELAY", 0.05))
+hedge_min_samples = int(os.environ.get("RASDAMAN_HEDGE_MIN_SAMPLES", 20))
+hedge_window = int(os.environ.get("RASDAMAN_HEDGE_WINDOW", 1000))
+
+# Hedge budget: every query earns `hedge_budget_ratio` tokens (up to `hedge_budget_burst`) and every hedge spends one.
+# With the default ratio, hedges can add at most ~10% extra load on the backends.
+hedge_budget_ratio = float(os.environ.get("RASDAMAN_HEDGE_BUDGET_RATIO", 0.1))
+hedge_budget_burst = float(os.environ.get("RASDAMAN_HEDGE_BUDGET_BURST", 10))
+
+upstream_timeout = float(os.environ.get("RASDAMAN_TIMEOUT", 60))
+
+
+#############################################################################################################
+# STATE
+#############################################################################################################
+
+# All state is shared between requests, and guarded by a lock since queries may also be run outside of the app's event loop
+_lock = threading.Lock()
+_latencies = deque(maxlen=hedge_window)
+_budget = hedge_budget_burst
+_primary = itertools.count()
+
+# a long-lived event loop (in a background thread) and client, so connections to the backends are reused across queries
+_loop = None
+_client = None
+
+hedge_metrics = {
+    "queries": 0,  # queries sent upstream
+    "hedges": 0,  # queries that were also sent to a second replica after the hedge delay
+    "hedge_wins": 0,  # hedged queries answered first by the second replica
+    "primary_wins": 0,  # hedged queries answered first by the first replica anyway
+    "budget_exhausted": 0,  # queries that should have been hedged, but the budget was spent
+    "failovers": 0,  # queries resent to another replica after a replica failed
+    "errors": 0,  # queries that failed on every replica tried
+}
+
+
+def get_hedge_delay():
+    """
+    Returns the current hedge delay in seconds, based on the percentile of recent upstream latencies.
+    """
+    with _lock:
+        latencies = sorted(_latencies)
+    if len(latencies) < hedge_min_samples:
+        return hedge_initial_delay
+    index = min(len(latencies) - 1, int(len(latencies) * hedge_percentile / 100))
+    return max(hedge_min_delay, latencies[index])
+
+
+def get_hedge_metrics():
+    """
+    Returns the hedge counters along with hedge rate, hedge win rate, current hedge delay and remaining budget.
+    """
+    with _lock:
+        metrics = dict(hedge_metrics)
+        budget = _budget
+    queries = metrics["queries"]
+    hedges = metrics["hedges"]
+    metrics["hedge_rate"] = hedges / queries if queries else 0.0
+    metrics["hedge_win_rate"] = metrics["hedge_wins"] / hedges if hedges else 0.0
+    metrics["hedge_delay"] = get_hedge_delay()
+    metrics["hedge_budget"] = budget
+    return metrics
+
+
+def _count(metric):
+    with _lock:
+        hedge_metrics[metric] += 1
+
+
+def _earn_budget():
+    global _budget
+    with _lock:
+        hedge_metrics["queries"] += 1
+        _budget = min(hedge_budget_burst, _budget + hedge_budget_ratio)
+
+
+def _spend_budget():
+    global _budget
+    with _lock:
+        if _budget < 1:
+            hedge_metrics["budget_exhausted"] += 1
+            return False
+        _budget -= 1
+        hedge_metrics["hedges"] += 1
+        return True
+
+
+#############################################################################################################
+# HEDGED REQUESTS
+#############################################################################################################
+
+
+def _record_latency(start):
+    with _lock:
+        _latencies.append(time.perf_counter() - start)
+
+
+async def _get(client, url, params, primary=False):
+    """
+    Sends one request to one backend, and records its latency for the hedge delay.
+    Only completed responses and timeouts are recorded, plus primary requests cancelled because a hedge won,
+    which were at least that slow. Cancelled hedges and fast failures (e.g. connection errors) are not recorded,
+    since they would pull the hedge delay down and trigger more hedging.
+    """
+    start = time.perf_counter()
+    try:
+        response = await client.get(url, params=params)
+    except httpx.TimeoutException:
+        _record_latency(start)
+        raise
+    except asyncio.CancelledError:
+        if primary:
+            _record_latency(start)
+        raise
+    _record_latency(start)
+    # server errors are worth retrying on another replica, client errors would fail on every replica
+    if response.status_code >= 500:
+        response.raise_for_status()
+    return response
+
+
+async def hedged_get(params, urls=None, client=None):
+    """
+    Sends a GET request with the given query parameters to one of the equivalent Rasdaman backends.
+    If there is no answer within the hedge delay, the same request is sent to a second backend (budget permitting).
+    The first response wins, and the other request is cancelled.
+    If a backend fails, the request is sent to the next backend until one answers or all have failed.
+    Returns the winning httpx.Response.
+    """
+    urls = urls or rasdaman_urls
+    if client is None:
+        async with httpx.AsyncClient(timeout=upstream_timeout) as client:
+            return await hedged_get(params, urls, client)
+
+    # rotate the first backend so the load is spread over all replicas
+    first = next(_primary) % len(urls)
+    urls = urls[first:] + urls[:first]
+
+    _earn_budget()
+    pending = {asyncio.ensure_future(_get(client, urls[0], params, primary=True)): 0}
+    next_url = 1
+    hedged = False
+    hedge_index = None
+    error = None
+
+    try:
+        while pending:
+            # wait for the hedge delay if there is still a replica to hedge to, otherwise wait for an answer
+            timeout = None
+            if not hedged and next_url < len(urls):
+                timeout = get_hedge_delay()
+            done, _ = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+
+            if not done:
+                hedged = True
+                if _spend_budget():
+                    hedge_index = next_url
+                    pending[
+                        asyncio.ensure_future(_get(client, urls[next_url], params))
+                    ] = next_url
+                    next_url += 1
+                continue
+
+            for task in done:
+                index = pending.pop(task)
+                if task.exception() is None:
+                    if hedge_index is not None and index == hedge_index:
+                        _count("hedge_wins")
+                    elif hedge_index is not None and index < hedge_index:
+                        _count("primary_wins")
+                    return task.result()
+                error = task.exception()
+
+            if not pending and next_url < len(urls):
+                _count("failovers")
+                pending[asyncio.ensure_future(_get(client, urls[next_url], params))] = (
+                    next_url
+                )
+                next_url += 1
+
+        _count("errors")
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+
+def _get_loop():
+    """
+    Returns the background event loop used for upstream queries, starting it (and its shared client) on first use.
+    """
+    global _loop, _client
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=loop.run_forever, name="rasdaman-upstream", daemon=True
+            ).start()
+
+            async def make_client():
+                return httpx.AsyncClient(timeout=upstream_timeout)
+
+            _client = asyncio.run_coroutine_threadsafe(make_client(), loop).result()
+            _loop = loop
+    return _loop
+
+
+def fetch_from_rasdaman(params, urls=None):
+    """
+    Synchronous wrapper around hedged_get() for use in the data fetching functions, which run in a worker thread.
+    Queries run on a long-lived background event loop with a shared client, so connections are pooled across queries,
+    and the racing requests can be cancelled without touching the app's event loop.
+    """
+    loop = _get_loop()
+    return asyncio.run_coroutine_threadsafe(
+        hedged_get(params, urls, _client), loop
+    ).result()
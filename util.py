@@ -1,4 +1,6 @@
 from catalog import data_catalog
+from artifacts import artifact_formats, artifact_key, get_artifact, put_artifact
+from estimate import estimate_request, check_request_limits
 
 
 def validate_parameters_against_catalog(parameters, catalog=data_catalog):
@@ -16,8 +18,10 @@ def fetch_data_using_catalog(parameters, catalog_subset):
     """
     Fetches data using coverage info from the metadata catalog and given parameters.
     This function will probably call other subfunctions to create WCPS queries to fetch the data.
+    Queries should be sent with fetch_from_rasdaman(), which hedges slow queries across the replicated Rasdaman backends.
     """
-    # perform data fetching operations using parameters and catalog_subset
+    # perform data fetching operations using parameters and catalog_subset, e.g.:
+    # response = fetch_from_rasdaman({"SERVICE": "WCS", "VERSION": "2.1.0", "REQUEST": "ProcessCoverages", "QUERY": wcps_query})
     data = {"data": {}}
     return data
 
@@ -33,9 +37,27 @@ def package_data(service_category, data, format):
 
 
 def check_for_data_and_package_it(service_category, parameters):
+    """
+    Binary outputs (see artifacts.py) are looked up in the artifact store first, and stored there after packaging,
+    so repeat requests never re-run fetching or packaging. In that case an Artifact is returned instead of the data.
+    Otherwise, requests that are estimated to be too large are rejected before any data is fetched.
+    """
+    if parameters.format in artifact_formats:
+        key = artifact_key(service_category, parameters)
+        artifact = get_artifact(key)
+        if artifact is not None:
+            return artifact
+
+    check_request_limits(estimate_request(service_category, parameters))
+
     catalog_subset = validate_parameters_against_catalog(parameters)
     data = fetch_data_using_catalog(parameters, catalog_subset)
-    packaged_data = package_data(parameters, service_category, data)
+    packaged_data = package_data(service_category, data, parameters.format)
+
+    if parameters.format in artifact_formats and isinstance(packaged_data, bytes):
+        return put_artifact(
+            key, packaged_data, parameters.format, f"{service_category}_{key[:12]}"
+        )
     return packaged_data
 
 